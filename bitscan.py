@@ -1,7 +1,11 @@
 import os
 import sys
+import time
+import bisect
 import pickle
 import signal
+import overlay
+import sharedstate
 from twitchbot import TwitchBot
 
 def bit_to_string(bit_amount, label):
@@ -14,15 +18,174 @@ def bit_to_string(bit_amount, label):
             bitf = str(bit_amount) + ' Bits'
     return bitf
 
+def event_user(message):
+    for username in (message.tag.display_name, message.tag.login, message.username):
+        if username.strip() != '':
+            return username
+    return ''
+
+# Aggregators each track one kind of event off the same parsed message. They
+# keep their state in bit_info under their own keys so it is saved, rendered
+# and published together, and update() returns an event dict when the
+# message was one of theirs.
+class BitAggregator:
+    name = 'bits'
+
+    def default(self):
+        return {'latest': { 'user': '', 'amount': 0 },
+                'max': { 'user': '', 'amount': 0},
+                'total': 0}
+
+    def update(self, bit_info, message, config):
+        if not message.tag.isCheer:
+            return None
+
+        amount = message.tag.bits
+        username = event_user(message)
+
+        bit_info['latest']['user'] = username
+        bit_info['latest']['amount'] = amount
+        bit_info['total'] += amount
+
+        if config['equal_max_override'].lower() == 'true':
+            if amount >= bit_info['max']['amount']:
+                bit_info['max']['user'] = username
+                bit_info['max']['amount'] = amount
+        else:
+            if amount > bit_info['max']['amount']:
+                bit_info['max']['user'] = username
+                bit_info['max']['amount'] = amount
+
+        return {'type': 'cheer', 'user': username, 'amount': amount}
+
+    def placeholders(self, bit_info, config):
+        include_label = config['amount_only'].lower() == 'false'
+        cutoff = int(config['max_user_len'])
+
+        return {'$latest': bit_info['latest']['user'][0:cutoff],
+                '$max': bit_info['max']['user'][0:cutoff],
+                '$lamount': bit_to_string(bit_info['latest']['amount'], include_label),
+                '$mamount': bit_to_string(bit_info['max']['amount'], include_label),
+                '$total': bit_to_string(bit_info['total'], include_label)}
+
+class SubAggregator:
+    name = 'subs'
+
+    def default(self):
+        return {'subs': {'latest': '', 'count': 0}}
+
+    def update(self, bit_info, message, config):
+        if message.IRCcmd != 'USERNOTICE' or message.tag.notice_id != 'sub':
+            return None
+
+        username = event_user(message)
+        bit_info['subs']['latest'] = username
+        bit_info['subs']['count'] += 1
+        return {'type': 'sub', 'user': username, 'plan': message.tag.msg_param_sub_plan}
+
+    def placeholders(self, bit_info, config):
+        cutoff = int(config['max_user_len'])
+        return {'$sub': bit_info['subs']['latest'][0:cutoff],
+                '$subs': str(bit_info['subs']['count'])}
+
+class ResubAggregator:
+    name = 'resubs'
+
+    def default(self):
+        return {'resubs': {'latest': '', 'months': 0, 'count': 0}}
+
+    def update(self, bit_info, message, config):
+        if message.IRCcmd != 'USERNOTICE' or message.tag.notice_id != 'resub':
+            return None
+
+        username = event_user(message)
+        months = message.tag.msg_param_months
+        bit_info['resubs']['latest'] = username
+        bit_info['resubs']['months'] = months
+        bit_info['resubs']['count'] += 1
+        return {'type': 'resub', 'user': username, 'months': months}
+
+    def placeholders(self, bit_info, config):
+        cutoff = int(config['max_user_len'])
+        return {'$resub': bit_info['resubs']['latest'][0:cutoff],
+                '$resubmonths': str(bit_info['resubs']['months']),
+                '$resubs': str(bit_info['resubs']['count'])}
+
+class GiftAggregator:
+    name = 'gifts'
+
+    def default(self):
+        return {'gifts': {'latest': '', 'recipient': '', 'count': 0}}
+
+    def update(self, bit_info, message, config):
+        if message.IRCcmd != 'USERNOTICE' or \
+           message.tag.notice_id not in ('subgift', 'anonsubgift'):
+            return None
+
+        username = event_user(message)
+        recipient = message.tag.msg_param_recipient
+        bit_info['gifts']['latest'] = username
+        bit_info['gifts']['recipient'] = recipient
+        bit_info['gifts']['count'] += 1
+        return {'type': 'gift', 'user': username, 'recipient': recipient}
+
+    def placeholders(self, bit_info, config):
+        cutoff = int(config['max_user_len'])
+        return {'$gifter': bit_info['gifts']['latest'][0:cutoff],
+                '$giftee': bit_info['gifts']['recipient'][0:cutoff],
+                '$gifts': str(bit_info['gifts']['count'])}
+
+class RaidAggregator:
+    name = 'raids'
+
+    def default(self):
+        return {'raids': {'latest': '', 'viewers': 0, 'count': 0}}
+
+    def update(self, bit_info, message, config):
+        if message.IRCcmd != 'USERNOTICE' or message.tag.notice_id != 'raid':
+            return None
+
+        username = message.tag.msg_param_display_name or event_user(message)
+        viewers = message.tag.msg_param_viewer_count
+        bit_info['raids']['latest'] = username
+        bit_info['raids']['viewers'] = viewers
+        bit_info['raids']['count'] += 1
+        return {'type': 'raid', 'user': username, 'viewers': viewers}
+
+    def placeholders(self, bit_info, config):
+        cutoff = int(config['max_user_len'])
+        return {'$raider': bit_info['raids']['latest'][0:cutoff],
+                '$raidsize': str(bit_info['raids']['viewers']),
+                '$raids': str(bit_info['raids']['count'])}
+
+AGGREGATORS = [BitAggregator, SubAggregator, ResubAggregator,
+               GiftAggregator, RaidAggregator]
+
+# The aggregators named in the "track" config option, in the order above.
+def load_aggregators(config):
+    names = [x.strip() for x in config['track'].split(',') if x.strip() != '']
+    known = [x.name for x in AGGREGATORS]
+    for name in names:
+        if name not in known:
+            print("Error: Unknown tracked event \"%s\"." % name)
+            sys.exit(1)
+
+    return [x() for x in AGGREGATORS if x.name in names]
+
+# Older bit.data files are missing the keys of newer aggregators.
 def load_bit_info():
     try:
         with open('bit.data', 'rb') as f:
             bit_info = pickle.load(f)
     except IOError:
-        bit_info = {
-            'latest': { 'user': '', 'amount': 0 },
-            'max': { 'user': '', 'amount': 0}
-        }
+        bit_info = {}
+
+    for aggregator in AGGREGATORS:
+        for key, value in aggregator().default().items():
+            bit_info.setdefault(key, value)
+
+    bit_info.setdefault('triggers', [])         # Names of the fired triggers
+    bit_info.setdefault('display', 'default')   # Template written to display.txt
 
     return bit_info
 
@@ -34,7 +197,15 @@ def read_bit_config(filename):
     config = {'max_user_len': '25',
               'amount_only': 'false',
               'equal_max_override': 'true',
-              'format': '$latest $latestamount $max $maxamount'
+              'format': '$latest $latestamount $max $maxamount',
+              'track': 'bits, subs, resubs, gifts, raids',
+              'activity_refresh': '1',
+              'shared_state': 'true',
+              'shared_state_file': 'bit.state',
+              'file_output': 'true',
+              'server': 'false',
+              'server_host': '127.0.0.1',
+              'server_port': '8080'
               }
     try:
         with open(filename, 'r') as f:
@@ -52,31 +223,249 @@ def read_bit_config(filename):
 
     return config
 
-def write_bit_config(filename, config, bit_info):
-    include_label = config['amount_only'].lower() == 'false'
+# The default template is "format", other named templates are given as
+# "format.<name>" in the config.
+def display_templates(config):
+    templates = {'default': config['format']}
+    for name in config:
+        if name.startswith('format.') and len(name) > len('format.'):
+            templates[name[len('format.'):]] = config[name]
+    return templates
+
+ACTIVITY_PLACEHOLDERS = ('$msgrate', '$chatters', '$cheerrate')
 
-    latest_amount = bit_to_string(bit_info['latest']['amount'], include_label)
-    max_amount = bit_to_string(bit_info['max']['amount'], include_label)
+# Chat activity from the bot's meters: messages a second over the last ten
+# seconds, distinct chatters and cheers over the last minute.
+def activity_values(bot):
+    return {'$msgrate': '%.1f' % bot.messagesPerSecond(),
+            '$chatters': str(bot.chattersPerMinute()),
+            '$cheerrate': str(bot.cheersPerMinute())}
 
-    cutoff = int(config['max_user_len'])
+def uses_activity(config):
+    for template in display_templates(config).values():
+        if any(x in template for x in ACTIVITY_PLACEHOLDERS):
+            return True
+    return False
 
-    display = config['format'].replace('\\n', '\n')
-    display = display.replace('$latest', bit_info['latest']['user'][0:cutoff])
-    display = display.replace('$max', bit_info['max']['user'][0:cutoff])
-    display = display.replace('$lamount', latest_amount)
-    display = display.replace('$mamount', max_amount)
+def display_values(config, bit_info, aggregators, bot=None):
+    values = {}
+    for aggregator in aggregators:
+        values.update(aggregator.placeholders(bit_info, config))
+    if bot is not None:
+        values.update(activity_values(bot))
+    return values
 
+# Longer placeholders go first so "$subs" isn't read as "$sub" + "s".
+def render_display(template, config, bit_info, aggregators=None, values=None,
+                   bot=None):
+    if values is None:
+        if aggregators is None:
+            aggregators = load_aggregators(config)
+        values = display_values(config, bit_info, aggregators, bot)
+
+    display = template.replace('\\n', '\n')
+    for placeholder in sorted(values, key=len, reverse=True):
+        display = display.replace(placeholder, values[placeholder])
+
+    return display
+
+def render_displays(config, bit_info, aggregators=None, bot=None):
+    if aggregators is None:
+        aggregators = load_aggregators(config)
+    values = display_values(config, bit_info, aggregators, bot)
+
+    templates = display_templates(config)
+    return {name: render_display(templates[name], config, bit_info, values=values)
+            for name in templates}
+
+def write_display(filename, display):
     try:
         with open(filename, 'w') as f:
             f.write(display)
     except IOError as i:
         print("Error: Writing to file: %s." % i)
 
+def write_bit_config(filename, config, bit_info):
+    write_display(filename, render_display(config['format'], config, bit_info))
+
+class Trigger:
+
+    def __init__(self, name, metric, threshold, callback, args):
+        self.name = name
+        self.metric = metric
+        self.threshold = threshold
+        self.callback = callback
+        self.args = args
+
+# Fires goals and milestones. The thresholds of each metric are kept sorted, so
+# when a value changes the crossed ones are the ones left of a bisect, and since
+# a trigger only ever fires once they are simply cut off the front. Fired names
+# are kept in bit_info['triggers'] so they stay fired across restarts.
+#
+# Metrics are "total" (running bit total), "single" (the amount of one cheer),
+# "subs" (subs and resubs), "gifts" (gift subs) and "raid" (raid size).
+class TriggerEngine:
+    METRICS = ('total', 'single', 'subs', 'gifts', 'raid')
+
+    def __init__(self, bit_info):
+        self.bit_info = bit_info
+
+        self.__fired = set(bit_info['triggers'])
+        self.__thresholds = {x: [] for x in self.METRICS}
+        self.__triggers = {x: [] for x in self.METRICS}
+
+    # The callback is called as callback(trigger, value) where value is what
+    # crossed the threshold. Returns False if the trigger already fired.
+    def add(self, name, metric, threshold, callback, args=None):
+        if metric not in self.METRICS:
+            raise ValueError("Unknown trigger metric \"%s\"." % metric)
+        if name in self.__fired:
+            return False
+
+        thresholds = self.__thresholds[metric]
+        i = bisect.bisect_right(thresholds, threshold)
+        thresholds.insert(i, threshold)
+        self.__triggers[metric].insert(i, Trigger(name, metric, threshold, callback, args))
+        return True
+
+    # Fires everything at or below value. Returns the fired triggers.
+    def update(self, metric, value):
+        thresholds = self.__thresholds[metric]
+        crossed = bisect.bisect_right(thresholds, value)
+        if crossed == 0:
+            return []
+
+        fired = self.__triggers[metric][0:crossed]
+        del thresholds[0:crossed]
+        del self.__triggers[metric][0:crossed]
+
+        for trigger in fired:
+            self.__fired.add(trigger.name)
+            self.bit_info['triggers'].append(trigger.name)
+            trigger.callback(trigger, value)
+
+        return fired
+
+    def updateFromEvents(self, events):
+        fired = []
+        for event in events:
+            if event['type'] == 'cheer':
+                fired += self.update('single', event['amount'])
+                fired += self.update('total', self.bit_info['total'])
+            elif event['type'] in ('sub', 'resub'):
+                fired += self.update('subs', self.bit_info['subs']['count'] +
+                                             self.bit_info['resubs']['count'])
+            elif event['type'] == 'gift':
+                fired += self.update('gifts', self.bit_info['gifts']['count'])
+            elif event['type'] == 'raid':
+                fired += self.update('raid', event['viewers'])
+        return fired
+
+# Triggers from the config, one per line:
+#   trigger.<name> = <metric> <threshold> msg <text>
+#   trigger.<name> = <metric> <threshold> display <template>
+# "msg" sends the text to chat with the display placeholders filled in, and
+# "display" switches the template written to display.txt.
+def load_triggers(config, bit_info, bot, aggregators):
+    engine = TriggerEngine(bit_info)
+    templates = display_templates(config)
+
+    def send_msg(trigger, value):
+        bot.msg(render_display(trigger.args, config, bit_info, aggregators, bot=bot))
+
+    def set_display(trigger, value):
+        bit_info['display'] = trigger.args
+
+    for key in sorted(config):
+        if not key.startswith('trigger.'):
+            continue
+
+        name = key[len('trigger.'):]
+        tokens = config[key].split(None, 3)
+        try:
+            if len(tokens) < 4 or tokens[2] not in ('msg', 'display'):
+                raise ValueError("needs a metric, threshold, \"msg\" or \"display\" and a value")
+            if tokens[2] == 'display' and tokens[3] not in templates:
+                raise ValueError("unknown template \"%s\"" % tokens[3])
+
+            callback = send_msg if tokens[2] == 'msg' else set_display
+            engine.add(name, tokens[0], int(tokens[1]), callback, tokens[3])
+        except ValueError as e:
+            print("Error: Trigger %s: %s." % (name, e))
+            sys.exit(1)
+
+    return engine
+
+# Flattens bit_info and the activity numbers into the shared state fields.
+def shared_values(bit_info, bot, display):
+    return {'latest_user': bit_info['latest']['user'],
+            'latest_amount': bit_info['latest']['amount'],
+            'max_user': bit_info['max']['user'],
+            'max_amount': bit_info['max']['amount'],
+            'total': bit_info['total'],
+            'sub_latest': bit_info['subs']['latest'],
+            'sub_count': bit_info['subs']['count'],
+            'resub_latest': bit_info['resubs']['latest'],
+            'resub_months': bit_info['resubs']['months'],
+            'resub_count': bit_info['resubs']['count'],
+            'gift_latest': bit_info['gifts']['latest'],
+            'gift_recipient': bit_info['gifts']['recipient'],
+            'gift_count': bit_info['gifts']['count'],
+            'raid_latest': bit_info['raids']['latest'],
+            'raid_viewers': bit_info['raids']['viewers'],
+            'raid_count': bit_info['raids']['count'],
+            'msg_rate': bot.messagesPerSecond(),
+            'chatters': bot.chattersPerMinute(),
+            'cheer_rate': bot.cheersPerMinute(),
+            'display': display}
+
+def start_shared_state(config):
+    if config['shared_state'].lower() != 'true':
+        return None
+
+    try:
+        return sharedstate.SharedStateWriter(config['shared_state_file'])
+    except (IOError, ValueError) as e:
+        print("Error: Shared state: %s." % e)
+        return None
+
+def start_overlay_server(config, bit_info, aggregators, bot):
+    if config['server'].lower() != 'true':
+        return None
+
+    try:
+        server = overlay.OverlayServer(config['server_host'], int(config['server_port']))
+        server.publish(bit_info, render_displays(config, bit_info, aggregators, bot))
+        server.start()
+    except (OSError, ValueError) as e:
+        print("Error: Overlay server: %s." % e)
+        return None
+    print("Overlay server on http://%s:%d/." % server.address)
+    return server
+
 def scan(bot, state):
     bit_info = load_bit_info()
     config = read_bit_config('bitconfig.txt')
+    aggregators = load_aggregators(config)
+    file_output = config['file_output'].lower() == 'true'
+    triggers = load_triggers(config, bit_info, bot, aggregators)
+    server = start_overlay_server(config, bit_info, aggregators, bot)
+    shared = start_shared_state(config)
+
+    # Activity placeholders and the shared state change without events, so
+    # they're re-rendered on their own every activity_refresh seconds. The
+    # outputs are only written when the rendered text or fields differ.
+    activity = uses_activity(config) or shared is not None
+    refresh = float(config['activity_refresh'])
+    rendered = time.monotonic()
+    last_displays = None
+    last_display = None     # Text last written to display.txt
 
     def exit_scan():
+        if server is not None:
+            server.stop()
+        if shared is not None:
+            shared.close()
         save_bit_info(bit_info)
         print('\nExiting program.')
         state.ack = True
@@ -86,27 +475,29 @@ def scan(bot, state):
         exit_scan()
      
     while state.on:
-        text = bot.incoming()
-        
-        if text.tag.isCheer:
-            amount = text.tag.bits
-            username = text.tag.display_name
-
-            if username.strip() == '':
-                username = text.username
-
-            bit_info['latest']['user'] = username
-            bit_info['latest']['amount'] = amount
-
-            if config['equal_max_override'].lower() == 'true':
-                if amount >= bit_info['max']['amount']:
-                    bit_info['max']['user'] = username
-                    bit_info['max']['amount'] = amount
-            else:
-                if amount > bit_info['max']['amount']:
-                    bit_info['max']['user'] = username
-                    bit_info['max']['amount'] = amount
-                        
-            write_bit_config('display.txt', config, bit_info)
+        bot.profiler.checkpoint('scan')
+        text = bot.incoming(timeout=1)
+
+        events = []
+        for aggregator in aggregators:
+            event = aggregator.update(bit_info, text, config)
+            if event is not None:
+                events.append(event)
+
+        if len(events) > 0 and len(triggers.updateFromEvents(events)) > 0:
+            save_bit_info(bit_info)
+
+        if len(events) > 0 or (activity and time.monotonic() - rendered >= refresh):
+            rendered = time.monotonic()
+            displays = render_displays(config, bit_info, aggregators, bot)
+            display = displays.get(bit_info['display'], displays['default'])
+            if file_output and display != last_display:
+                write_display('display.txt', display)
+                last_display = display
+            if (displays != last_displays or len(events) > 0) and server is not None:
+                server.publish(bit_info, displays, events)
+            if shared is not None:
+                shared.publish(shared_values(bit_info, bot, display))
+            last_displays = displays
 
     exit_scan()
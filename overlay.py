@@ -0,0 +1,169 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+Optional local HTTP server for browser-source overlays. Instead of having OBS
+poll display.txt, overlays connect to the server and get the rendered
+displays pushed to them with Server-Sent Events:
+
+   /events          Event stream. A "display" event carries the rendered
+                    templates whenever they change, and each tracked event
+                    is sent as it happens ("cheer", "sub", "resub", "gift"
+                    or "raid").
+   /overlay/<name>  Minimal page showing the named template, usable directly
+                    as a browser source.
+   /display/<name>  The named template as plain text.
+   /state           The latest bit_info snapshot as JSON.
+
+The scan thread renders everything once per update and publishes it as a
+read-only snapshot, so connected overlays never touch bit_info itself.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import copy
+import json
+import queue
+import threading
+import http.server
+
+_OVERLAY_PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+body { margin: 0; color: white; font: 32px sans-serif; white-space: pre; }
+</style></head><body><div id="display"></div><script>
+var name = %s;
+var events = new EventSource('/events');
+events.addEventListener('display', function (e) {
+    var displays = JSON.parse(e.data).displays;
+    if (name in displays)
+        document.getElementById('display').textContent = displays[name];
+});
+</script></body></html>
+'''
+
+# Handles a single overlay connection. Runs on its own thread, reading only
+# from the published snapshot and its own event queue.
+class _OverlayHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        overlay = self.server.overlay
+        path = self.path.split('?')[0].rstrip('/')
+
+        if path == '/events':
+            self.__stream(overlay)
+        elif path == '/state':
+            body = json.dumps(overlay.snapshot()['bit_info'])
+            self.__reply(200, 'application/json', body)
+        elif path.startswith('/display/'):
+            displays = overlay.snapshot()['displays']
+            name = path[len('/display/'):]
+            if name in displays:
+                self.__reply(200, 'text/plain; charset=utf-8', displays[name])
+            else:
+                self.__reply(404, 'text/plain', "Unknown template %s." % name)
+        elif path.startswith('/overlay/'):
+            name = path[len('/overlay/'):]
+            self.__reply(200, 'text/html; charset=utf-8',
+                         _OVERLAY_PAGE % json.dumps(name))
+        else:
+            self.__reply(404, 'text/plain', "Not found.")
+
+    def log_message(self, format, *args):
+        None
+
+    def __reply(self, code, ctype, body):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __stream(self, overlay):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        events = overlay.subscribe()
+        try:
+            self.__send('display', overlay.snapshot())
+            while overlay.active:
+                try:
+                    name, data = events.get(timeout=15)
+                    self.__send(name, data)
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+        except OSError:
+            None
+        finally:
+            overlay.unsubscribe(events)
+
+    def __send(self, name, data):
+        self.wfile.write(("event: %s\ndata: %s\n\n" %
+                          (name, json.dumps(data))).encode('utf-8'))
+        self.wfile.flush()
+
+class OverlayServer:
+
+    def __init__(self, host='127.0.0.1', port=8080, backlog=64):
+        self.address = (host, port)
+        self.backlog = backlog  # Events kept per client before dropping
+
+        self.active = False
+        # End declarations
+
+        self.__snapshot = {'bit_info': {}, 'displays': {}}
+        self.__clients = []
+        self.__lock = threading.Lock()  # Guards the client list only
+        self.__httpd = None
+        self.__thread = None
+
+    def start(self):
+        self.__httpd = http.server.ThreadingHTTPServer(self.address, _OverlayHandler)
+        self.__httpd.daemon_threads = True
+        self.__httpd.overlay = self
+        self.address = self.__httpd.server_address[0:2]
+
+        self.active = True
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, args=())
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.active = False
+        if self.__httpd is not None:
+            self.__httpd.shutdown()
+            self.__httpd.server_close()
+            self.__httpd = None
+
+    # The snapshot is replaced, never modified, so readers can use it
+    # without locking.
+    def snapshot(self):
+        return self.__snapshot
+
+    # Called by the scan thread after each update. A client that has fallen
+    # behind by more than the backlog misses events rather than slowing the
+    # scan down; the next display event brings it up to date.
+    def publish(self, bit_info, displays, events=()):
+        snapshot = {'bit_info': copy.deepcopy(bit_info), 'displays': dict(displays)}
+        self.__snapshot = snapshot
+
+        with self.__lock:
+            clients = list(self.__clients)
+
+        for client in clients:
+            try:
+                for event in events:
+                    client.put_nowait((event['type'], event))
+                client.put_nowait(('display', snapshot))
+            except queue.Full:
+                None
+
+    def subscribe(self):
+        events = queue.Queue(self.backlog)
+        with self.__lock:
+            self.__clients.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.__lock:
+            if events in self.__clients:
+                self.__clients.remove(events)
@@ -0,0 +1,187 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+On-demand profiling for a running bot. A capture is started with trigger(),
+usually from a SIGUSR1 handler, runs for a fixed number of seconds and dumps
+its results to timestamped files in the working directory while the bot
+keeps running:
+
+   profile-<time>-samples.txt  Sampled stacks of every thread, one collapsed
+                               stack per line ("thread;outer;...;inner count"),
+                               in "sample" mode.
+   profile-<time>-<name>.prof  cProfile stats of each thread that calls
+                               checkpoint(), in "cprofile" mode. Open with
+                               pstats. From Python 3.12 cProfile covers the
+                               whole interpreter, so there is a single
+                               profile-<time>-all.prof instead.
+   profile-<time>-alloc.txt    tracemalloc allocations made during the
+                               capture, largest first.
+
+The sampler reads the other threads' frames from its own thread and costs
+nothing outside of a capture. Before Python 3.12 cProfile has to be enabled
+by the thread being profiled, so the loops call checkpoint() once per
+iteration; outside of a capture that is a single attribute check. Only one
+cProfile can be active at a time from 3.12 on, so the capture thread enables
+it once for every thread and checkpoint() does nothing. If cProfile can't be
+enabled (a debugger or coverage tool already holds it) the capture falls back
+to sampling; a failed capture never raises into the calling loops.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os
+import sys
+import time
+import cProfile
+import threading
+import tracemalloc
+import collections
+
+class Profiler:
+
+    def __init__(self, seconds=30, mode='sample', interval=0.005):
+        self.seconds = seconds    # Length of a capture
+        self.mode = None          # "sample" or "cprofile"
+        self.interval = interval  # Seconds between stack samples
+        self.directory = '.'
+
+        self.capturing = False
+        # End declarations
+
+        self.__lock = threading.Lock()
+        self.__profiles = {}      # Thread name -> cProfile.Profile
+        self.__prefix = ''
+        self.__shared = sys.version_info >= (3, 12)  # One cProfile per interpreter
+        self.__fallback = False   # cProfile failed, sample the rest of the capture
+
+        self.setMode(mode)
+
+    def setMode(self, mode):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError("Profile mode needs to be \"sample\" or \"cprofile\"")
+        self.mode = mode
+
+    # Starts a capture in the background. Safe to call from a signal handler;
+    # does nothing if a capture is already running.
+    def trigger(self, seconds=None):
+        with self.__lock:
+            if self.capturing:
+                return False
+            self.capturing = True
+
+        if seconds is None:
+            seconds = self.seconds
+
+        thread = threading.Thread(target=self.__capture, args=(seconds,),
+                                  name='profiler')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    # Called by the threads that want to show up in a cProfile capture.
+    def checkpoint(self, name):
+        if (self.capturing and not self.__shared) or self.__profiles:
+            try:
+                self.__checkpoint(name)
+            except (ValueError, OSError) as e:
+                print("Profiling %s failed: %s" % (name, e))
+                self.__profiles.pop(name, None)
+                self.__fallback = True
+
+    def __checkpoint(self, name):
+        if self.capturing and self.mode == 'cprofile' and not self.__fallback:
+            if name not in self.__profiles:
+                profile = cProfile.Profile()
+                profile.enable()
+                self.__profiles[name] = profile
+        elif name in self.__profiles:
+            profile = self.__profiles.pop(name)
+            profile.disable()
+            profile.dump_stats(self.__path('%s.prof' % name))
+
+    def __path(self, suffix):
+        return os.path.join(self.directory, '%s-%s' % (self.__prefix, suffix))
+
+    def __capture(self, seconds):
+        self.__prefix = time.strftime('profile-%Y%m%d-%H%M%S')
+        print("Profiling for %g seconds." % seconds)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+
+        self.__fallback = False
+        try:
+            if self.mode == 'sample':
+                self.__sample(seconds)
+            elif self.__shared:
+                self.__profileAll(seconds)
+            else:
+                self.__waitOrSample(seconds)
+
+            after = tracemalloc.take_snapshot()
+            self.__writeAllocations(before, after)
+        except (ValueError, OSError) as e:
+            print("Profiling failed: %s" % e)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            self.capturing = False
+
+        print("Profile written to %s-*." % self.__path('')[:-1])
+
+    def __profileAll(self, seconds):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            print("cProfile unavailable (%s), sampling instead." % e)
+            self.__sample(seconds)
+            return
+        try:
+            time.sleep(seconds)
+        finally:
+            profile.disable()
+        profile.dump_stats(self.__path('all.prof'))
+
+    # Waits out a per-thread cProfile capture, switching to sampling for the
+    # remainder if a thread couldn't enable its profiler.
+    def __waitOrSample(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if self.__fallback:
+                print("cProfile unavailable, sampling instead.")
+                self.__sample(deadline - time.monotonic())
+                return
+            time.sleep(min(0.1, max(deadline - time.monotonic(), 0)))
+
+    def __sample(self, seconds):
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append('%s (%s:%d)' % (code.co_name,
+                                                 os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(calls))] += 1
+            time.sleep(self.interval)
+
+        with open(self.__path('samples.txt'), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+    def __writeAllocations(self, before, after, limit=50):
+        stats = after.compare_to(before, 'traceback')
+        with open(self.__path('alloc.txt'), 'w') as f:
+            for stat in stats[0:limit]:
+                f.write('%s\n' % stat)
+                for line in stat.traceback.format():
+                    f.write('    %s\n' % line)
@@ -20,15 +20,21 @@ def main(argv):
         while state.ack is False: None
         sys.exit(0)
 
+    def signal_profile(signal, frame):
+        bot.profiler.trigger()
+
     signal.signal(signal.SIGINT, signal_exit)
     signal.signal(signal.SIGTERM, signal_exit)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal_profile)
 
     while 1:
         bot = TwitchBot()
         bot.setInfoFromConfig('bot.txt')
         bot.start()
 
-        scan_thread = threading.Thread(target=bitscan.scan, args=(bot,state))
+        scan_thread = threading.Thread(target=bitscan.scan, args=(bot,state),
+                                       name='scan')
         
         state.on = True
         state.ack = False
@@ -0,0 +1,180 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+Live bitscan state in a memory-mapped file, for overlays, stream deck plugins
+and dashboards that would otherwise parse display.txt or unpickle bit.data.
+bitscan writes the file with SharedStateWriter whenever a field changes; any
+local process can read it with SharedStateReader:
+
+   reader = SharedStateReader('bit.state')
+   state = reader.read()
+   print(state['latest_user'], state['total'])
+
+Polling is cheap: changed() only compares the generation counter, and read()
+unpacks the fields straight from the mapping. The module only uses the
+standard library so it can be copied next to any tool. From a shell:
+
+   python sharedstate.py bit.state [--watch]
+
+The layout is fixed and versioned. The header is
+
+   magic "BSCN", version (u16), header size (u16), payload size (u32),
+   4 bytes of padding, generation (u64), update time (f64, unix seconds)
+
+followed by the fields in FIELDS order, little endian. Strings are UTF-8,
+NUL padded to their width. The generation works as a seqlock: the writer
+makes it odd before changing the payload and even again after, so a reader
+that sees the same even generation before and after unpacking has a
+consistent snapshot. The generation sits at offset 16, on an 8-byte boundary,
+so readers in any language can load it in a single read.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os
+import sys
+import time
+import json
+import mmap
+import struct
+
+MAGIC = b'BSCN'
+VERSION = 2
+
+FIELDS = [('latest_user', '64s'), ('latest_amount', 'q'),
+          ('max_user', '64s'), ('max_amount', 'q'),
+          ('total', 'q'),
+          ('sub_latest', '64s'), ('sub_count', 'q'),
+          ('resub_latest', '64s'), ('resub_months', 'q'), ('resub_count', 'q'),
+          ('gift_latest', '64s'), ('gift_recipient', '64s'), ('gift_count', 'q'),
+          ('raid_latest', '64s'), ('raid_viewers', 'q'), ('raid_count', 'q'),
+          ('msg_rate', 'd'), ('chatters', 'q'), ('cheer_rate', 'q'),
+          ('display', '1024s')]
+
+_HEADER = struct.Struct('<4sHHI4xQd')
+_GENERATION = struct.Struct('<Q')
+_GENERATION_OFFSET = 16
+_PAYLOAD = struct.Struct('<' + ''.join(x[1] for x in FIELDS))
+_NAMES = [x[0] for x in FIELDS]
+_STRINGS = set(x[0] for x in FIELDS if x[1].endswith('s'))
+
+SIZE = _HEADER.size + _PAYLOAD.size
+
+class SharedStateWriter:
+
+    def __init__(self, filename='bit.state'):
+        self.filename = filename
+        self.generation = 0
+        self.payload = None   # Last packed payload, to skip unchanged updates
+
+        # An existing file is reused in place rather than truncated, so
+        # readers that still have it mapped keep working across restarts.
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size != SIZE:
+            self.__file.truncate(SIZE)
+        self.__map = mmap.mmap(fd, SIZE)
+
+        magic, version, _, _, generation, updated = _HEADER.unpack_from(self.__map)
+        if magic == MAGIC and version == VERSION:
+            self.generation = generation + generation % 2
+        else:
+            updated = 0.0
+        _HEADER.pack_into(self.__map, 0, MAGIC, VERSION, _HEADER.size,
+                          _PAYLOAD.size, self.generation, updated)
+
+    # Missing fields are written as zero or empty. Nothing is written, and
+    # the generation stays the same, if no field changed since the last call.
+    def publish(self, values):
+        packed = []
+        for name, fmt in FIELDS:
+            value = values.get(name)
+            if name in _STRINGS:
+                packed.append((value or '').encode('utf-8'))
+            elif fmt == 'd':
+                packed.append(float(value or 0))
+            else:
+                packed.append(int(value or 0))
+        payload = _PAYLOAD.pack(*packed)
+        if payload == self.payload:
+            return False
+        self.payload = payload
+
+        self.generation += 1
+        _GENERATION.pack_into(self.__map, _GENERATION_OFFSET, self.generation)
+        self.__map[_HEADER.size:SIZE] = payload
+        struct.pack_into('<d', self.__map, _GENERATION_OFFSET + 8, time.time())
+        self.generation += 1
+        _GENERATION.pack_into(self.__map, _GENERATION_OFFSET, self.generation)
+        return True
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+class SharedStateReader:
+
+    def __init__(self, filename='bit.state'):
+        self.filename = filename
+        self.seen = -1     # Generation of the last read()
+
+        self.__file = open(filename, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.__map) < _HEADER.size:
+            raise ValueError("%s is not a bitscan state file." % filename)
+        magic, version, header_size, payload_size = _HEADER.unpack_from(self.__map)[0:4]
+        if magic != MAGIC:
+            raise ValueError("%s is not a bitscan state file." % filename)
+        if version != VERSION or header_size != _HEADER.size or \
+           payload_size != _PAYLOAD.size or len(self.__map) < SIZE:
+            raise ValueError("%s has layout version %d, expected %d." %
+                             (filename, version, VERSION))
+
+    def generation(self):
+        return _GENERATION.unpack_from(self.__map, _GENERATION_OFFSET)[0]
+
+    def changed(self):
+        return self.generation() != self.seen
+
+    # Returns the fields as a dict, plus "generation" and "updated". Retries
+    # while the writer is in the middle of an update.
+    def read(self, retries=1000):
+        for _ in range(retries):
+            before = self.generation()
+            if before % 2 == 1:
+                time.sleep(0)
+                continue
+
+            values = _PAYLOAD.unpack_from(self.__map, _HEADER.size)
+            updated = struct.unpack_from('<d', self.__map, _GENERATION_OFFSET + 8)[0]
+
+            if self.generation() == before:
+                self.seen = before
+                state = dict(zip(_NAMES, values))
+                for name in _STRINGS:
+                    state[name] = state[name].rstrip(b'\0').decode('utf-8', 'ignore')
+                state['generation'] = before
+                state['updated'] = updated
+                return state
+            time.sleep(0)
+
+        raise RuntimeError("No consistent snapshot of %s." % self.filename)
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: %s <state file> [--watch]" % os.path.basename(argv[0]))
+        return 1
+
+    reader = SharedStateReader(argv[1])
+    print(json.dumps(reader.read(), indent=2))
+
+    while '--watch' in argv:
+        time.sleep(0.05)
+        if reader.changed():
+            print(json.dumps(reader.read()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,144 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+Memory soak benchmark. Replays IRC traffic through TwitchBot.incoming() and
+the bitscan aggregators, with history, spam detection and a command turned
+on, and records the RSS and tracemalloc size as it goes. The traffic is
+either a capture of raw IRC lines (one per line, as read from the socket)
+replayed over and over, or generated with a large pool of users who join,
+chat, cheer and often leave without a PART:
+
+   python soak.py --messages 2000000
+   python soak.py --capture chat.log --messages 5000000
+
+Steady state memory should be flat: the growth over the second half of the
+run is compared against --max-growth and the exit status is 1 if it's over.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+import bitscan
+from twitchbot import TwitchBot
+
+_WORDS = ['pog', 'lul', 'gg', 'hello', 'chat', 'raid', 'hype', 'what', 'is',
+          'this', 'clip', 'it', 'no', 'way', 'lets', 'go', 'bits', 'sub']
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def capture_lines(filename):
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        lines = [x.rstrip('\r\n') for x in f if x.strip() != '']
+    if len(lines) == 0:
+        raise ValueError("Capture %s has no lines." % filename)
+    while True:
+        for line in lines:
+            yield line
+
+def synthetic_lines(users, channel, seed):
+    rand = random.Random(seed)
+    n = 0
+    while True:
+        n += 1
+        user = 'user%d' % rand.randrange(users)
+        roll = rand.random()
+        prefix = ':%s!%s@%s.tmi.twitch.tv' % (user, user, user)
+
+        if roll < 0.05:
+            yield '%s JOIN %s' % (prefix, channel)
+        elif roll < 0.07:
+            yield '%s PART %s' % (prefix, channel)
+        elif roll < 0.08:
+            yield ('@badges=;bits=%d;display-name=%s;id=%d %s PRIVMSG %s :cheer%d'
+                   % (rand.choice((1, 100, 500)), user, n, prefix, channel, 1))
+        elif roll < 0.085:
+            yield ('@display-name=%s;login=%s;msg-id=resub;msg-param-months=%d '
+                   ':tmi.twitch.tv USERNOTICE %s :hype'
+                   % (user, user, rand.randrange(1, 60), channel))
+        elif roll < 0.09:
+            yield '%s PRIVMSG %s :!bits' % (prefix, channel)
+        else:
+            body = ' '.join(rand.choice(_WORDS) for _ in range(rand.randrange(1, 12)))
+            if rand.random() < 0.5:
+                body = '%s %d' % (body, n)
+            yield ('@badges=;color=#FF0000;display-name=%s;emotes=;id=%d;mod=0;'
+                   'room-id=1;subscriber=0;turbo=0;user-id=%d;user-type= %s PRIVMSG %s :%s'
+                   % (user, n, hash(user) & 0xffffff, prefix, channel, body))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Memory soak benchmark.")
+    parser.add_argument('--capture', help="File of raw IRC lines to replay.")
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=500000,
+                        help="Size of the synthetic user pool.")
+    parser.add_argument('--max-users', type=int, default=10000,
+                        help="TwitchBot.maxusers, lower so the cap is reached.")
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--max-growth', type=float, default=2.0,
+                        help="Allowed growth in MB over the second half.")
+    parser.add_argument('--no-tracemalloc', action='store_true')
+    args = parser.parse_args(argv[1:])
+
+    channel = '#soak'
+    if args.capture:
+        lines = capture_lines(args.capture)
+    else:
+        lines = synthetic_lines(args.users, channel, 1)
+
+    bot = TwitchBot()
+    bot.channel = channel
+    bot.setPrintOptions(allmsg=False)
+    bot.maxusers = args.max_users
+    bot.enableHistory(capacity=20000, max_age=600)
+    bot.setSpamOptions()
+    bot.addCommand('!bits', lambda message, args: None, user_cooldown=30)
+
+    config = {'max_user_len': '25', 'amount_only': 'false',
+              'equal_max_override': 'true', 'track': 'bits, subs, resubs, gifts, raids'}
+    aggregators = bitscan.load_aggregators(config)
+    bit_info = {}
+    for aggregator in aggregators:
+        bit_info.update(aggregator.default())
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    every = max(args.messages // args.samples, 1)
+    samples = []
+    started = time.time()
+
+    print("%12s %10s %12s %10s %10s" % ('messages', 'rss MB', 'traced MB', 'users', 'msg/s'))
+    for n in range(1, args.messages + 1):
+        bot.feed(next(lines))
+        message = bot.incoming()
+        for aggregator in aggregators:
+            aggregator.update(bit_info, message, config)
+
+        if n % every == 0:
+            traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            sample = (n, rss_bytes() / 1e6, traced / 1e6)
+            samples.append(sample)
+            print("%12d %10.1f %12.1f %10d %10.0f" %
+                  (sample + (len(bot.userlist), n / (time.time() - started))))
+
+    half = samples[len(samples) // 2 - 1]
+    last = samples[-1]
+    growth = max(last[1] - half[1], last[2] - half[2])
+    print("Growth over the second half: rss %+.1f MB, traced %+.1f MB." %
+          (last[1] - half[1], last[2] - half[2]))
+
+    if growth > args.max_growth:
+        print("Memory is still growing (limit %.1f MB)." % args.max_growth)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -12,20 +12,34 @@ From there the bot will read the configuration from the config file and
 do all the connections.
 
 Use incoming() to receive text which will return an IRCMessage instance.
+The socket itself is read on a separate thread which answers PINGs and
+queues every other line, so incoming() returns one message per call.
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
+import os
 import re
+import sys
 import time
 import json
+import math
+import array
 import socket
+import select
+import tempfile
+import collections
 import random
 import datetime
 import requests
 import threading
+import profiling
 
 # Class for parsing the IRC incoming messages.
 # Not every message will be associated with every variable
+# Commands, channels and tag keys repeat in almost every message, so they are
+# interned. Usernames aren't: interned strings are immortal on some Python
+# versions and the set of chatters has no bound. TwitchBot shares the copy
+# already kept in its user list instead.
 class _IRCMessage:
 
     def __init__(self, text):
@@ -44,6 +58,7 @@ class _IRCMessage:
         self.argument  = ''
 
         self.tag = None
+        self.spam = ''         # Why the spam detector flagged it, if it did
         # End declarations
 
         if text.startswith(':'):
@@ -58,13 +73,13 @@ class _IRCMessage:
                 self.host = self.prefix.split('!')[1].split('@')[0]
                 self.serv = self.prefix.split('!')[1].split('@')[0]
 
-            self.IRCcmd = self.message.split()[1]
+            self.IRCcmd = sys.intern(self.message.split()[1])
             
             self.IRCparams = []
             for token in self.message.split(' ')[2:]:
                 if token.startswith(':'):
                     break
-                self.IRCparams.append(token)
+                self.IRCparams.append(sys.intern(token))
 
             if len(text.split(':')) > 2:
                 self.body     = ':'.join(text.split(':')[2:])
@@ -102,8 +117,15 @@ class _IRCTag:
         self.subs_only = False
         self.slow = 0
         
+        # For NOTICE and USERNOTICE
+        self.notice_id = ''    # msg-id, e.g. "slow_on" or "resub"
+
         # For USERNOTICE
         self.msg_param_months = 0
+        self.msg_param_sub_plan = ''
+        self.msg_param_recipient = ''     # Gift sub recipient display name
+        self.msg_param_display_name = ''  # Raider display name
+        self.msg_param_viewer_count = 0   # Raid size
         self.system_msg = ''
         self.login = ''
         
@@ -139,13 +161,18 @@ class _IRCTag:
                 elif item == 'r9k': self.r9k = value == '1'
                 elif item == 'subs-only': self.subs_only = value == '1'
                 elif item == 'slow': self.slow = int(value)
+                elif item == 'msg-id': self.notice_id = value
                 elif item == 'msg-param-months': self.msg_param_months = int(value)
+                elif item == 'msg-param-sub-plan': self.msg_param_sub_plan = value
+                elif item == 'msg-param-recipient-display-name': self.msg_param_recipient = value
+                elif item == 'msg-param-displayName': self.msg_param_display_name = value
+                elif item == 'msg-param-viewerCount': self.msg_param_viewer_count = int(value)
                 elif item == 'system-msg': self.system_msg = value
                 elif item == 'login': self.login = value
                 elif item == 'ban-duration': self.ban_duration = int(value)
                 elif item == 'ban-reason': self.ban_reason = value
 
-                self.tags.append(item)
+                self.tags.append(sys.intern(item))
 
 # A timer that stores a time delay (minutes, seconds, hours) that can be checked
 # Interfaced by _BotTimers, and controlled by TwitchBot
@@ -255,7 +282,718 @@ class _BotTimers:
                 self.timerList.remove(e)
             self.lock.release()
             time.sleep(1)
-            
+
+# A cache whose entries expire a fixed number of seconds after they are set.
+# Entries stay in the order they were set, so the expired ones are always at
+# the front and get evicted as new ones come in. maxsize caps it regardless.
+class _TTLCache:
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        self.__entries = collections.OrderedDict()  # key -> (expiry, value)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None, now=None):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return default
+        if now is None:
+            now = time.monotonic()
+        if entry[0] <= now:
+            return default
+        return entry[1]
+
+    def contains(self, key, now=None):
+        return self.get(key, None, now) is not None
+
+    def set(self, key, value=True, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        self.__entries.pop(key, None)
+        self.__entries[key] = (now + self.ttl, value)
+
+        while len(self.__entries) > 0:
+            expiry = next(iter(self.__entries.values()))[0]
+            if expiry > now and len(self.__entries) <= self.maxsize:
+                break
+            self.__entries.popitem(last=False)
+
+# Fixed-size ring of recent chat messages for moderation lookups. A slot keeps
+# only the time, username and body of a message, plus the sequence number of
+# the same user's previous message. Walking that chain back from the user's
+# latest message finds their messages without a scan or a list per user, and
+# since the times only grow, time ranges are found with a binary search.
+# Messages are returned as (time, username, body) tuples, oldest first.
+class _MessageHistory:
+
+    def __init__(self, capacity=10000, max_age=0):
+        self.capacity = capacity
+        self.max_age = max_age    # Seconds a message is kept, 0 for no limit
+
+        self.__times  = array.array('d', bytes(8 * capacity))
+        self.__prev   = array.array('q', bytes(8 * capacity))
+        self.__users  = [None] * capacity
+        self.__bodies = [None] * capacity
+        self.__first  = 0         # Sequence number of the oldest message
+        self.__next   = 0         # Sequence number of the next message
+        self.__latest = {}        # username -> sequence number of their last
+        # End declarations
+
+        if capacity < 1:
+            raise ValueError("History capacity must be a positive integer.")
+
+    def __len__(self):
+        return self.__next - self.__first
+
+    def append(self, username, body, now=None):
+        if now is None:
+            now = time.time()
+        self.__expire(now)
+
+        if self.__next - self.__first >= self.capacity:
+            self.__dropOldest()
+
+        slot = self.__next % self.capacity
+        self.__times[slot] = now
+        self.__prev[slot] = self.__latest.get(username, -1)
+        self.__users[slot] = username
+        self.__bodies[slot] = body
+
+        self.__latest[username] = self.__next
+        self.__next += 1
+
+    # The last count messages from a user, or all of them kept.
+    def byUser(self, username, count=None, now=None):
+        self.__expire(now)
+        seqs = []
+        seq = self.__latest.get(username, -1)
+        while seq >= self.__first and (count is None or len(seqs) < count):
+            seqs.append(seq)
+            seq = self.__prev[seq % self.capacity]
+        return [self.__record(seq) for seq in reversed(seqs)]
+
+    # Messages with start <= time <= end.
+    def between(self, start, end=None, now=None):
+        self.__expire(now)
+        first = self.__search(start, False)
+        last = self.__next if end is None else self.__search(end, True)
+        return [self.__record(seq) for seq in range(first, last)]
+
+    def __record(self, seq):
+        slot = seq % self.capacity
+        return (self.__times[slot], self.__users[slot], self.__bodies[slot])
+
+    # First sequence number with a time >= t, or > t when after is set.
+    def __search(self, t, after):
+        lo, hi = self.__first, self.__next
+        while lo < hi:
+            mid = (lo + hi) // 2
+            stamp = self.__times[mid % self.capacity]
+            if stamp < t or (after and stamp == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __expire(self, now):
+        if self.max_age <= 0:
+            return
+        if now is None:
+            now = time.time()
+
+        cutoff = now - self.max_age
+        while self.__first < self.__next and \
+              self.__times[self.__first % self.capacity] < cutoff:
+            self.__dropOldest()
+
+    def __dropOldest(self):
+        slot = self.__first % self.capacity
+        username = self.__users[slot]
+
+        # It was the user's only message left
+        if self.__latest[username] == self.__first:
+            del self.__latest[username]
+
+        self.__users[slot] = None
+        self.__bodies[slot] = None
+        self.__first += 1
+
+# Allows up to count events every per seconds, refilling continuously.
+class _RateLimiter:
+
+    def __init__(self, count, per):
+        self.count = count
+        self.per = per
+
+        self.__tokens = float(count)
+        self.__last = time.monotonic()
+
+    def allow(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        self.__tokens = min(self.count,
+                            self.__tokens + (now - self.__last) * self.count / self.per)
+        self.__last = now
+
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+_SPAM_STRIP = re.compile(r'[\W_]+')
+
+# Flags repeated messages and users posting too fast. Bodies are normalized and
+# hashed, and the hashes are counted in a few time buckets which together cover
+# the window, so a check only touches a fixed number of dicts however busy the
+# chat is. Each user's rate is a sliding window counter: the counts of the
+# current and previous period, with the previous one weighted by how much of
+# it still overlaps the window.
+class _SpamDetector:
+
+    def __init__(self, window=30, repeats=5, length=10, rate=8, period=5,
+                 buckets=6, maxsize=20000):
+        self.window = window      # Seconds a repeated message is remembered
+        self.repeats = repeats    # Copies within the window that get flagged
+        self.length = length      # Shorter normalized bodies are not counted
+        self.rate = rate          # Messages per period that get a user flagged
+        self.period = period
+
+        self.__span = float(window) / buckets
+        self.__bucket_max = maxsize // buckets
+        self.__buckets = collections.deque([{} for _ in range(buckets)])
+        self.__bucket_id = 0
+        self.__users = _TTLCache(2 * period, maxsize)
+        # End declarations
+
+    # Returns "repeat" or "rate" when the message should be flagged.
+    def check(self, username, body, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        start, previous, current = self.__users.get(username, (now, 0, 0), now)
+        if now - start >= self.period:
+            periods = int((now - start) // self.period)
+            previous = current if periods == 1 else 0
+            current = 0
+            start += periods * self.period
+        current += 1
+        self.__users.set(username, (start, previous, current), now)
+
+        overlap = 1 - (now - start) / self.period
+        if previous * overlap + current >= self.rate:
+            return 'rate'
+
+        normal = _SPAM_STRIP.sub('', body.lower())
+        if len(normal) < self.length:
+            return None
+
+        self.__rotate(now)
+        key = hash(normal)
+        count = 1
+        for bucket in self.__buckets:
+            count += bucket.get(key, 0)
+
+        current = self.__buckets[-1]
+        if key in current or len(current) < self.__bucket_max:
+            current[key] = current.get(key, 0) + 1
+
+        if count >= self.repeats:
+            return 'repeat'
+        return None
+
+    def __rotate(self, now):
+        bucket_id = int(now // self.__span)
+        steps = min(bucket_id - self.__bucket_id, len(self.__buckets))
+        for _ in range(steps):
+            self.__buckets.popleft()
+            self.__buckets.append({})
+        self.__bucket_id = bucket_id
+
+# Approximate distinct counter (HyperLogLog) in 2^precision one-byte
+# registers. Sketches with the same precision are merged by taking the
+# larger register, which is how windows made of several of them are counted.
+class _HyperLogLog:
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = hash(value) & 0xFFFFFFFFFFFFFFFF
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def clear(self):
+        self.registers[:] = bytes(len(self.registers))
+
+    @staticmethod
+    def estimate(registers):
+        m = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(float(m) / zeros)
+        return estimate
+
+# Chat activity for one channel. Messages and cheers are counted per second on
+# a ring of 60 slots, and chatters go into six HyperLogLog sketches of ten
+# seconds each. Every slot remembers which second it holds and is reset when
+# reused, so an update is O(1) and the memory never grows.
+class _ActivityMeter:
+
+    def __init__(self, seconds=60, sketches=6, precision=10):
+        self.seconds = seconds
+        self.sketch_span = seconds // sketches
+
+        self.__stamps = array.array('q', [-1] * seconds)
+        self.__messages = array.array('I', bytes(4 * seconds))
+        self.__cheers = array.array('I', bytes(4 * seconds))
+        self.__sketch_ids = array.array('q', [-1] * sketches)
+        self.__sketches = [_HyperLogLog(precision) for _ in range(sketches)]
+
+    def update(self, username, cheer, now=None):
+        if now is None:
+            now = time.time()
+        second = int(now)
+
+        slot = second % self.seconds
+        if self.__stamps[slot] != second:
+            self.__stamps[slot] = second
+            self.__messages[slot] = 0
+            self.__cheers[slot] = 0
+        self.__messages[slot] += 1
+        if cheer:
+            self.__cheers[slot] += 1
+
+        sketch_id = second // self.sketch_span
+        slot = sketch_id % len(self.__sketches)
+        if self.__sketch_ids[slot] != sketch_id:
+            self.__sketch_ids[slot] = sketch_id
+            self.__sketches[slot].clear()
+        self.__sketches[slot].add(username)
+
+    def messages(self, seconds, now=None):
+        return self.__sum(self.__messages, seconds, now)
+
+    def cheers(self, seconds, now=None):
+        return self.__sum(self.__cheers, seconds, now)
+
+    # Distinct chatters over the whole ring.
+    def chatters(self, now=None):
+        if now is None:
+            now = time.time()
+        oldest = int(now) // self.sketch_span - len(self.__sketches)
+
+        merged = None
+        for sketch_id, sketch in zip(self.__sketch_ids, self.__sketches):
+            if sketch_id <= oldest:
+                continue
+            if merged is None:
+                merged = bytearray(sketch.registers)
+            else:
+                merged = bytearray(map(max, merged, sketch.registers))
+
+        if merged is None:
+            return 0
+        return int(round(_HyperLogLog.estimate(merged)))
+
+    def __sum(self, counts, seconds, now):
+        if now is None:
+            now = time.time()
+        oldest = int(now) - min(seconds, self.seconds)
+
+        total = 0
+        for stamp, count in zip(self.__stamps, counts):
+            if stamp > oldest:
+                total += count
+        return total
+
+# A chat command registered with TwitchBot.addCommand().
+class _Command:
+
+    def __init__(self, name, callback, args, aliases,
+                 user_cooldown, global_cooldown, mod_only):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.aliases = aliases
+        self.mod_only = mod_only
+
+        self.global_cooldown = global_cooldown
+        self.global_until = 0    # time.monotonic() the global cooldown ends
+
+        self.users = None        # Users still on cooldown
+        # End declarations
+
+        if user_cooldown > 0:
+            self.users = _TTLCache(user_cooldown)
+
+    # Checks and starts the cooldowns. Returns False if the command is still
+    # cooling down for everyone or for this user.
+    def ready(self, username, now):
+        if now < self.global_until:
+            return False
+        if self.users is not None:
+            if self.users.contains(username, now):
+                return False
+            self.users.set(username, True, now)
+
+        self.global_until = now + self.global_cooldown
+        return True
+
+# Checks the raw tag section of a line for a cheer without parsing the tags.
+def _isCheerLine(line):
+    if not line.startswith('@'):
+        return False
+    tags = line.partition(' ')[0]
+    return tags.startswith('@bits=') or tags.find(';bits=') != -1
+
+# Bounded queue between the socket reader and incoming(). When it is full the
+# policy decides what happens to the next line:
+#   "block" - the reader waits until incoming() makes room or the queue is
+#             closed. While it waits nothing is read from the socket, so
+#             server PINGs go unanswered and the health checks don't run;
+#             a consumer that falls far enough behind gets disconnected, and
+#             the reader reconnects once it is back.
+#   "drop"  - non-cheer lines are dropped first; a cheer evicts the oldest
+#             non-cheer line and is only dropped if the queue holds only cheers.
+#   "spill" - lines go to a spill file and are read back in order. An existing
+#             file is never overwritten: if the spill file name is taken a
+#             unique name next to it is used. The file is removed on close().
+#             If the file can't be written the line is handled as in "drop"
+#             and the error is reported once.
+#
+# put() is called from the reader thread and never raises.
+class _MessageQueue:
+
+    def __init__(self, maxsize=4096, policy='drop', spillfile='spill.txt',
+                 spillmax=1000000):
+        self.maxsize = maxsize
+        self.policy = None
+        self.spillfile = spillfile
+        self.spillmax = spillmax  # Lines the spill file may hold
+
+        self.drops = 0        # Non-cheer lines dropped
+        self.cheer_drops = 0  # Cheers dropped with a full queue or spill file
+        self.spilled = 0      # Lines waiting in the spill file
+        self.closed = False
+
+        self.__queue = collections.deque()
+        self.__cond = threading.Condition()
+        self.__spill = None
+        self.__spill_path = None
+        self.__spill_pos = 0
+        self.__spill_error = False  # An error has been reported
+        # End declarations
+
+        self.setPolicy(policy)
+
+    def setPolicy(self, policy):
+        if policy not in ('block', 'drop', 'spill'):
+            raise ValueError("Queue policy needs to be \"block\", \"drop\", or \"spill\"")
+        self.policy = policy
+
+    def depth(self):
+        return len(self.__queue) + self.spilled
+
+    def put(self, line):
+        with self.__cond:
+            if self.closed:
+                return
+
+            # Once spilling, everything goes to the file to keep the order
+            if self.spilled > 0 and self.spilled < self.spillmax:
+                self.__spillLine(line)
+            elif self.spilled > 0:
+                self.__countDrop(line)
+            elif len(self.__queue) < self.maxsize:
+                self.__queue.append(line)
+            elif self.policy == 'block':
+                while len(self.__queue) >= self.maxsize and not self.closed:
+                    self.__cond.wait()
+                self.__queue.append(line)
+            elif self.policy == 'drop':
+                self.__dropFor(line)
+            elif self.spilled < self.spillmax:
+                self.__spillLine(line)
+            else:
+                self.__countDrop(line)
+
+            self.__cond.notify_all()
+
+    # Returns the next line, or None once the queue is closed and empty or
+    # the timeout runs out.
+    def get(self, timeout=None):
+        with self.__cond:
+            while len(self.__queue) == 0 and self.spilled == 0:
+                if self.closed or not self.__cond.wait(timeout):
+                    return None
+
+            if len(self.__queue) > 0:
+                line = self.__queue.popleft()
+            else:
+                line = self.__unspillLine()
+
+            self.__cond.notify_all()
+            return line
+
+    def close(self):
+        with self.__cond:
+            self.closed = True
+            if self.spilled == 0:
+                self.__closeSpill()
+            self.__cond.notify_all()
+
+    def __countDrop(self, line):
+        if _isCheerLine(line):
+            self.cheer_drops += 1
+        else:
+            self.drops += 1
+
+    def __dropFor(self, line):
+        if not _isCheerLine(line):
+            self.drops += 1
+            return
+
+        for i, queued in enumerate(self.__queue):
+            if not _isCheerLine(queued):
+                del self.__queue[i]
+                self.__queue.append(line)
+                self.drops += 1
+                return
+
+        self.cheer_drops += 1
+
+    def __spillLine(self, line):
+        end = None
+        try:
+            if self.__spill is None:
+                self.__openSpill()
+            end = self.__spill.seek(0, 2)
+            data = line.encode('utf-8') + b'\n'
+            while len(data) > 0:
+                data = data[self.__spill.write(data):]
+        except OSError as e:
+            if not self.__spill_error:
+                print("Error: Spill file: %s." % e)
+                self.__spill_error = True
+            self.__truncateSpill(end)
+            if self.spilled == 0:
+                self.__dropFor(line)
+            else:
+                self.__countDrop(line)
+            return
+
+        self.__spill_error = False
+        self.spilled += 1
+
+    # Cuts off a partly written line.
+    def __truncateSpill(self, end):
+        if self.__spill is None or end is None:
+            return
+        try:
+            self.__spill.truncate(end)
+        except OSError:
+            None
+
+    # Spilled lines can still be read after close(); the file goes once
+    # they have been.
+    def __closeSpill(self):
+        if self.__spill is None:
+            return
+        self.__spill.close()
+        self.__spill = None
+        try:
+            os.remove(self.__spill_path)
+        except OSError:
+            None
+
+    def __openSpill(self):
+        try:
+            fd = os.open(self.spillfile, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            self.__spill_path = self.spillfile
+        except FileExistsError:
+            directory, name = os.path.split(self.spillfile)
+            fd, self.__spill_path = tempfile.mkstemp(prefix=name + '.',
+                                                     dir=directory or '.')
+        # Unbuffered, so a failed write can be cut off cleanly
+        self.__spill = os.fdopen(fd, 'w+b', buffering=0)
+        self.__spill_pos = 0
+
+    def __unspillLine(self):
+        self.__spill.seek(self.__spill_pos)
+        data = b''
+        while data.find(b'\n') == -1:
+            chunk = self.__spill.read(4096)
+            if not chunk:
+                break
+            data += chunk
+        line = data.partition(b'\n')[0]
+        self.__spill_pos += len(line) + 1
+        self.spilled -= 1
+
+        if self.spilled == 0 and self.closed:
+            self.__closeSpill()
+        elif self.spilled == 0:
+            self.__spill.seek(0)
+            self.__spill.truncate()
+            self.__spill_pos = 0
+
+        return line.decode('utf-8', 'replace')
+
+# Reads the socket on its own thread. It only frames the lines and handles
+# the PING/PONG control frames; everything else is handed to incoming() through
+# the message queue so slow printing or file writes never hold up the next recv.
+#
+# The reader also sends its own PINGs to measure the round trip time. If a PONG
+# doesn't come back in time, or nothing at all has been read for too long, the
+# connection is treated as stalled and reconnect() is called before Twitch
+# drops it.
+class _IRCReader:
+
+    def __init__(self, sock, send, queue, reconnect):
+        self.sock = sock
+        self.send = send
+        self.queue = queue
+        self.reconnect = reconnect
+
+        self.ping_interval = 60  # Seconds between our own PINGs
+        self.ping_timeout = 10   # Seconds to wait for the matching PONG
+
+        self.rtt = None          # Last measured round trip, in seconds
+        self.last_byte = 0       # time.monotonic() of the last recv
+        self.reconnects = 0
+
+        self.profiler = None
+        self.active = False
+        # End declarations
+
+        self.__ping_token = None  # Outstanding PING payload
+        self.__ping_sent = 0
+        self.__ping_count = 0
+        self.__pending = b''      # Partial line from the last recv
+
+        self.thread = threading.Thread(target=self.__loop, args=(), name='reader')
+        self.thread.daemon = True
+
+    def begin(self):
+        self.active = True
+        self.__resetHealth()
+        self.thread.start()
+
+    def idleTime(self):
+        return time.monotonic() - self.last_byte
+
+    def __resetHealth(self):
+        self.last_byte = time.monotonic()
+        self.__ping_token = None
+        self.__ping_sent = self.last_byte
+        self.__pending = b''
+
+    # The socket is shared with the bot's sends, so it stays blocking and the
+    # reader waits on select() instead of giving it a timeout.
+    def __loop(self):
+        while self.active:
+            if self.profiler is not None:
+                self.profiler.checkpoint('reader')
+
+            try:
+                sock = self.sock
+                if not select.select([sock], [], [], 1)[0]:
+                    self.__checkHealth()
+                    continue
+                data = sock.recv(4096)
+            except (OSError, ValueError):
+                data = b''
+
+            if not data:
+                if not self.active:
+                    break
+                self.__reconnect()
+                continue
+
+            self.last_byte = time.monotonic()
+
+            lines = (self.__pending + data).split(b'\n')
+            self.__pending = lines.pop()
+
+            for raw in lines:
+                line = raw.rstrip(b'\r').decode('utf-8', 'replace')
+                if line != '' and not self.__controlFrame(line):
+                    self.queue.put(line)
+
+            self.__checkHealth()
+
+        self.active = False
+        self.queue.close()
+
+    # Handles server PINGs and the PONGs to our own PINGs. Only the IRC command
+    # is looked at, so chat text containing "PING" is passed on as normal.
+    def __controlFrame(self, line):
+        if line.startswith('PING'):
+            self.__sendControl("PONG%s\r\n" % line[4:])
+            return True
+
+        if line.startswith(':'):
+            tokens = line.split(' ', 2)
+            if len(tokens) < 2 or tokens[1] != 'PONG':
+                return False
+            if self.__ping_token is not None and line.endswith(self.__ping_token):
+                self.rtt = time.monotonic() - self.__ping_sent
+                self.__ping_token = None
+            return True
+
+        return False
+
+    def __checkHealth(self):
+        now = time.monotonic()
+
+        if self.__ping_token is not None:
+            if now - self.__ping_sent > self.ping_timeout:
+                self.__reconnect()
+        elif now - self.__ping_sent >= self.ping_interval:
+            self.__ping_count += 1
+            self.__ping_token = "bitscan%d" % self.__ping_count
+            self.__ping_sent = now
+            self.__sendControl("PING :%s\r\n" % self.__ping_token)
+        elif now - self.last_byte > self.ping_interval + self.ping_timeout:
+            self.__reconnect()
+
+    # A failed PING or PONG means the connection is gone.
+    def __sendControl(self, text):
+        try:
+            sent = self.send(text)
+        except OSError:
+            sent = False
+        if sent is False:
+            self.__reconnect()
+
+    # Keeps trying with a growing delay until the connection is back or the
+    # reader is stopped.
+    def __reconnect(self):
+        delay = 1
+        while self.active:
+            try:
+                self.reconnect()
+                self.reconnects += 1
+                self.__resetHealth()
+                return
+            except OSError as e:
+                print("Error: Reconnecting: %s." % e)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
 # General class for the IRC connection. Contains all join and messaging commands
 class TwitchBot:
     __PRINT_OPT_MSG   = 0b00000001
@@ -270,6 +1008,11 @@ class TwitchBot:
 
     def __init__(self):
         self.__chat   = None    # Socket connection.
+        self.__reader = None    # Socket reader thread
+        self.__queue  = None    # Lines waiting for incoming()
+        self.__pingopts = {'interval': 60, 'timeout': 10}
+        self.__profile_on_start = False
+        self.__sendlock = None  # Keeps the reader and bot from interleaving sends
         self.__timers = None    # Timer loop
         self.__timercode = 0    # Timer count
         self.__printopts = 0b1100101  # Printing options
@@ -278,11 +1021,30 @@ class TwitchBot:
         self.channel    = None
         self.username   = None
         self.password   = None
+
+        self.profiler   = None  # Started with profiler.trigger()
     
         self.userlist = []    # All the users in the channel.
         self.modlist  = []    # All the elevated users, hop and higher.
+        self.maxusers = 50000 # PARTs get missed, so the oldest users are
+                              # dropped from userlist past this.
+        self.__usernames = {}   # Same users as userlist, for lookups; each
+                                # maps to the stored string so messages share it
 
         self.__variables = {}
+        self.__commands  = {}   # Command names and aliases -> _Command
+        self.__history   = None # Recent messages, see enableHistory()
+        self.__spam      = None # Spam detector, see setSpamOptions()
+        self.__spamopts  = {'window': 30, 'repeats': 5, 'length': 10,
+                            'rate': 8, 'period': 5, 'action': 'none',
+                            'duration': 60, 'limit': 20}
+        self.__spamcallback = None
+        self.__modactions = None  # Limits the moderation commands sent
+        self.__modacted = None    # Users recently timed out or purged
+        self.__meters = {}        # Channel -> _ActivityMeter
+        self.__slowopts = {'rate': 0, 'time': 30}
+        self.__slowauto = False   # Slow mode was turned on by the bot
+        self.__slowcheck = 0      # time.monotonic() of the last slow check
 
         # Room states
         self.subs_on = False
@@ -295,6 +1057,9 @@ class TwitchBot:
         # End declarations
         
         self.__chat = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__queue = _MessageQueue()
+        self.profiler = profiling.Profiler()
+        self.__sendlock = threading.RLock()
         self.__timers = _BotTimers()
 
     def setInfoFromConfig(self, filename):
@@ -351,7 +1116,7 @@ class TwitchBot:
                 if not password.startswith('oauth:'):
                     raise ValueError("Oauth must start with \"oauth:\" [%s]." % password)
                 self.password = password
-            elif re.fullmatch('(user|print)\.[a-z]+', cname.strip()) != None:
+            elif re.fullmatch('(user|print|queue|ping|profile|history|spam|limit|slow)\.[a-z]+', cname.strip()) != None:
                 namepath = cname.strip().split('.')
                 option = cvalue.strip()
                 self.__parseOptions(namepath, option)
@@ -403,6 +1168,83 @@ class TwitchBot:
                 self.setPrintOptions(state=opt)
             elif namepath[1] == 'allmsg':
                 self.setPrintOptions(allmsg=opt)
+        elif namepath[0] == 'queue':
+            if namepath[1] == 'size':
+                try:
+                    self.setQueueOptions(size=int(value))
+                except ValueError:
+                    raise TypeError("Queue option \"size\" not a valid number.")
+            elif namepath[1] == 'policy':
+                self.setQueueOptions(policy=value)
+            elif namepath[1] == 'spillfile':
+                self.setQueueOptions(spillfile=value)
+            else:
+                raise ValueError("Unknown queue option \"%s\"." % namepath[1])
+        elif namepath[0] == 'ping':
+            if namepath[1] not in ('interval', 'timeout'):
+                raise ValueError("Unknown ping option \"%s\"." % namepath[1])
+            try:
+                seconds = float(value)
+            except ValueError:
+                raise TypeError("Ping option \"%s\" not a valid number." % namepath[1])
+            if namepath[1] == 'interval':
+                self.setPingOptions(interval=seconds)
+            else:
+                self.setPingOptions(timeout=seconds)
+        elif namepath[0] == 'profile':
+            if namepath[1] == 'mode':
+                self.profiler.setMode(value)
+            elif namepath[1] == 'seconds':
+                try:
+                    self.profiler.seconds = float(value)
+                except ValueError:
+                    raise TypeError("Profile option \"seconds\" not a valid number.")
+            elif namepath[1] == 'onstart':
+                if value not in ('true', 'false'):
+                    raise TypeError("Profile option \"onstart\" not of type boolean")
+                self.__profile_on_start = value == 'true'
+            else:
+                raise ValueError("Unknown profile option \"%s\"." % namepath[1])
+        elif namepath[0] == 'history':
+            if namepath[1] not in ('size', 'age'):
+                raise ValueError("Unknown history option \"%s\"." % namepath[1])
+            try:
+                number = int(value)
+            except ValueError:
+                raise TypeError("History option \"%s\" not a valid number." % namepath[1])
+            if namepath[1] == 'size':
+                self.enableHistory(capacity=number)
+            else:
+                self.enableHistory(max_age=number)
+        elif namepath[0] == 'spam':
+            option = namepath[1]
+            if option not in self.__spamopts:
+                raise ValueError("Unknown spam option \"%s\"." % option)
+            if option == 'action':
+                self.setSpamOptions(action=value)
+            else:
+                try:
+                    self.setSpamOptions(**{option: int(value)})
+                except ValueError:
+                    raise TypeError("Spam option \"%s\" not a valid number." % option)
+        elif namepath[0] == 'slow':
+            if namepath[1] not in self.__slowopts:
+                raise ValueError("Unknown slow option \"%s\"." % namepath[1])
+            try:
+                number = float(value)
+            except ValueError:
+                raise TypeError("Slow option \"%s\" not a valid number." % namepath[1])
+            if namepath[1] == 'rate':
+                self.setAutoSlow(rate=number)
+            else:
+                self.setAutoSlow(seconds=int(number))
+        elif namepath[0] == 'limit':
+            if namepath[1] != 'users':
+                raise ValueError("Unknown limit option \"%s\"." % namepath[1])
+            try:
+                self.maxusers = int(value)
+            except ValueError:
+                raise TypeError("Limit option \"users\" not a valid number.")
 
     # Sets what will be printed to stdout.
     def setPrintOptions(self, **kwargs):
@@ -436,6 +1278,53 @@ class TwitchBot:
             else:
                 self.__printopts = self.__PRINT_OPT_NONE
 
+    # Sets the incoming queue size, overflow policy and spill file.
+    def setQueueOptions(self, **kwargs):
+        if 'size' in kwargs:
+            if not isinstance(kwargs['size'], int) or kwargs['size'] < 1:
+                raise ValueError("Queue size must be a positive integer.")
+            self.__queue.maxsize = kwargs['size']
+        if 'policy' in kwargs:
+            self.__queue.setPolicy(kwargs['policy'])
+        if 'spillfile' in kwargs:
+            self.__queue.spillfile = kwargs['spillfile']
+
+    # Sets how often the reader PINGs the server and how long it waits for
+    # the PONG before reconnecting.
+    def setPingOptions(self, **kwargs):
+        for key in kwargs:
+            if key not in self.__pingopts:
+                raise KeyError("Unknown ping option \"%s\"." % key)
+            if not isinstance(kwargs[key], (int, float)) or kwargs[key] <= 0:
+                raise ValueError("Ping option \"%s\" must be a positive number." % key)
+            self.__pingopts[key] = kwargs[key]
+
+        if self.__reader is not None:
+            self.__reader.ping_interval = self.__pingopts['interval']
+            self.__reader.ping_timeout = self.__pingopts['timeout']
+
+    # Connection health
+    def pingLatency(self):
+        if self.__reader is None:
+            return None
+        return self.__reader.rtt
+    def idleTime(self):
+        if self.__reader is None:
+            return None
+        return self.__reader.idleTime()
+    def reconnectCount(self):
+        if self.__reader is None:
+            return 0
+        return self.__reader.reconnects
+
+    # Queue statistics
+    def queueDepth(self):
+        return self.__queue.depth()
+    def queueDrops(self):
+        return self.__queue.drops
+    def queueCheerDrops(self):
+        return self.__queue.cheer_drops
+
     # Timer controls
     def initializeTimers(self):
         self.__timers = _BotTimers()
@@ -508,6 +1397,154 @@ class TwitchBot:
         self.__timers.lock.release()
         return False
 
+    # Chat commands. The callback is called as callback(message, args) for
+    # each PRIVMSG whose first word is the name or one of the aliases.
+    # Cooldowns are in seconds, and a command on cooldown or limited to mods
+    # is rejected before the callback runs.
+    def addCommand(self, name, callback, args=None, aliases=(),
+                   user_cooldown=0, global_cooldown=0, mod_only=False):
+        names = [x.lower() for x in (name,) + tuple(aliases)]
+        for cname in names:
+            if cname in self.__commands:
+                raise KeyError("Command \"%s\" already exists." % cname)
+
+        command = _Command(names[0], callback, args, names[1:],
+                           user_cooldown, global_cooldown, mod_only)
+        for cname in names:
+            self.__commands[cname] = command
+    def removeCommand(self, name):
+        name = name.lower()
+        if name not in self.__commands:
+            raise KeyError("Command \"%s\" not found." % name)
+        command = self.__commands[name]
+        for cname in [command.name] + command.aliases:
+            del self.__commands[cname]
+    def commandExists(self, name):
+        return name.lower() in self.__commands
+
+    # Message history. Keeps the last capacity PRIVMSGs, and drops those older
+    # than max_age seconds when it is set.
+    def enableHistory(self, capacity=None, max_age=None):
+        if self.__history is None:
+            self.__history = _MessageHistory()
+        if capacity is not None and capacity != self.__history.capacity:
+            self.__history = _MessageHistory(capacity, self.__history.max_age)
+        if max_age is not None:
+            self.__history.max_age = max_age
+    def disableHistory(self):
+        self.__history = None
+    def historyEnabled(self):
+        return self.__history is not None
+    def userHistory(self, username, count=None):
+        if self.__history is None:
+            return []
+        return self.__history.byUser(username.lower(), count)
+    def recentHistory(self, seconds):
+        if self.__history is None:
+            return []
+        return self.__history.between(time.time() - seconds)
+    def historyBetween(self, start, end=None):
+        if self.__history is None:
+            return []
+        return self.__history.between(start, end)
+
+    # Spam detection. Setting any option turns it on. Flagged messages have
+    # their spam attribute set to "repeat" or "rate", are not dispatched as
+    # commands, and depending on the action the user is purged or timed out
+    # for duration seconds. At most limit moderation commands go out every 30
+    # seconds, and mods are never checked.
+    def setSpamOptions(self, **kwargs):
+        for key in kwargs:
+            if key not in self.__spamopts:
+                raise KeyError("Unknown spam option \"%s\"." % key)
+        if kwargs.get('action', 'none') not in ('none', 'purge', 'timeout'):
+            raise ValueError("Spam action needs to be \"none\", \"purge\", or \"timeout\"")
+        self.__spamopts.update(kwargs)
+
+        opts = self.__spamopts
+        self.__spam = _SpamDetector(opts['window'], opts['repeats'], opts['length'],
+                                    opts['rate'], opts['period'])
+        self.__modactions = _RateLimiter(opts['limit'], 30)
+        self.__modacted = _TTLCache(max(opts['duration'], 1))
+    def setSpamCallback(self, callback, args=None):
+        self.__spamcallback = (callback, args)
+    def disableSpamDetection(self):
+        self.__spam = None
+    def spamDetectionEnabled(self):
+        return self.__spam is not None
+
+    def __handleSpam(self, message):
+        if self.__spamcallback is not None:
+            self.__spamcallback[0](message, self.__spamcallback[1])
+
+        action = self.__spamopts['action']
+        if action == 'none' or self.__modacted.contains(message.username):
+            return
+        if not self.__modactions.allow():
+            return
+
+        self.__modacted.set(message.username)
+        if action == 'purge':
+            self.purge(message.username)
+        else:
+            self.timeout(message.username, self.__spamopts['duration'])
+
+    # Chat activity, counted on every PRIVMSG. Channel defaults to the bot's.
+    def messagesPerSecond(self, channel=None, seconds=10):
+        meter = self.__meters.get(channel or self.channel)
+        if meter is None:
+            return 0.0
+        return meter.messages(seconds) / float(seconds)
+    def chattersPerMinute(self, channel=None):
+        meter = self.__meters.get(channel or self.channel)
+        if meter is None:
+            return 0
+        return meter.chatters()
+    def cheersPerMinute(self, channel=None):
+        meter = self.__meters.get(channel or self.channel)
+        if meter is None:
+            return 0
+        return meter.cheers(60)
+
+    # Turns slow mode on for the given seconds when chat goes over rate messages
+    # a second, and back off once it drops under half of that. A rate of 0
+    # turns it off. Slow mode set by someone else is left alone.
+    def setAutoSlow(self, rate=None, seconds=None):
+        if rate is not None:
+            self.__slowopts['rate'] = rate
+        if seconds is not None:
+            self.__slowopts['time'] = seconds
+
+    def __checkSlow(self, now):
+        if now - self.__slowcheck < 5:
+            return
+        self.__slowcheck = now
+
+        rate = self.messagesPerSecond()
+        if not self.slow_on and not self.__slowauto and rate > self.__slowopts['rate']:
+            self.__slowauto = True
+            self.slowon(self.__slowopts['time'])
+        elif self.__slowauto and rate < self.__slowopts['rate'] / 2.0:
+            self.__slowauto = False
+            self.slowoff()
+
+    def isMod(self, username, tag=None):
+        if tag is not None and tag.isMod:
+            return True
+        username = username.lower()
+        return username in self.modlist or '#' + username == self.channel
+
+    def __dispatchCommand(self, message):
+        command = self.__commands.get(message.command.lower())
+        if command is None:
+            return
+        if command.mod_only and not self.isMod(message.username, message.tag):
+            return
+        if not command.ready(message.username, time.monotonic()):
+            return
+
+        command.callback(message, command.args)
+
     def __request_chat_server(self, streamer):
         chaturl = 'https://tmi.twitch.tv'
         r = requests.get("%s/servers?channel=%s" % (chaturl, streamer))
@@ -530,38 +1567,90 @@ class TwitchBot:
 
         print("Connecting to %s." % self.server)
         
-        self.__connectServer(self.server)
-        self.__authorize(self.password)
-        self.__connectUsername(self.username)
-        self.__connectUser(self.username, "Hello")
-        self.__activateJoin()
-        self.__activateTags()
+        self.__chat = self.__connectServer(self.server)
+        self.__startReader()
+        self.__login()
 
         print("Bot username set as %s." % self.username)
         print("Joining channel %s." % self.channel)
 
         self.join(self.channel)
 
+    # Called from the reader thread when the connection drops or stalls.
+    # The new connection is made outside the send lock, so other threads'
+    # sends fail fast on the old socket instead of waiting on the connect.
+    # The swap and login hold the lock so nothing is sent on a socket that
+    # is being replaced or before the login.
+    def __reconnect(self):
+        print("Connection to %s lost, reconnecting." % self.server)
+
+        chat = self.__connectServer(self.server)
+
+        with self.__sendlock:
+            try:
+                self.__chat.close()
+            except OSError:
+                None
+
+            self.__chat = chat
+            self.__reader.sock = self.__chat
+            self.__login()
+            self.join(self.channel)
+
+    def __login(self):
+        self.__authorize(self.password)
+        self.__connectUsername(self.username)
+        self.__connectUser(self.username, "Hello")
+        self.__activateJoin()
+        self.__activateTags()
+
     # Internal connection initializations.
     def __connectServer(self, server):
-        self.__chat.connect((server, 6667))
+        # The ping timeout also bounds the connect, then sends block as normal
+        chat = socket.create_connection((server, 6667), self.__pingopts['timeout'])
+        chat.settimeout(None)
+        return chat
     def __connectUser(self, username, message):
-        self.__chat.send(("USER %s botnick botnick :%s\r\n" % (username, message)).encode('utf-8'))
+        self.__send("USER %s botnick botnick :%s\r\n" % (username, message))
     def __connectUsername(self, username):
-        self.__chat.send(("NICK %s\r\n" % username).encode('utf-8'))
+        self.__send("NICK %s\r\n" % username)
     def __authorize(self, password):
-        self.__chat.send(("PASS %s\r\n" % password).encode('utf-8'))
+        self.__send("PASS %s\r\n" % password)
     def __activateJoin(self):
-        self.__chat.send(("CAP REQ :twitch.tv/membership\r\n").encode('utf-8'))
+        self.__send("CAP REQ :twitch.tv/membership\r\n")
     def __activateTags(self):
-        self.__chat.send(("CAP REQ :twitch.tv/tags\r\n").encode('utf-8'))
+        self.__send("CAP REQ :twitch.tv/tags\r\n")
     def join(self, channel):
-        self.__chat.send(("JOIN %s\r\n" % channel).encode('utf-8'))
+        self.__send("JOIN %s\r\n" % channel)
     def part(self, channel):
-        self.__chat.send(("PART %s\r\n" % channel).encode('utf-8'))
-
-    def __getText(self):
-        return self.__chat.recv(2048).decode('utf-8')
+        self.__send("PART %s\r\n" % channel)
+
+    def __startReader(self):
+        self.__reader = _IRCReader(self.__chat, self.__send, self.__queue,
+                                   self.__reconnect)
+        self.__reader.ping_interval = self.__pingopts['interval']
+        self.__reader.ping_timeout = self.__pingopts['timeout']
+        self.__reader.profiler = self.profiler
+        self.__reader.begin()
+
+        if self.__profile_on_start:
+            self.profiler.trigger()
+
+    # Never raises: msg() is called from the scan, timer and command threads.
+    # A failed send shuts the socket down so the reader sees the connection
+    # end and reconnects. Returns whether the text was sent.
+    def __send(self, text):
+        with self.__sendlock:
+            try:
+                self.__chat.sendall(text.encode('utf-8'))
+                return True
+            except OSError as e:
+                print("Error: Sending: %s." % e)
+                try:
+                    self.__chat.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    None
+                return False
 
     def __printText(self, irc, raw_text, msg_text):
         if self.__printopts & self.__PRINT_OPT_NONE != 0:
@@ -595,53 +1684,94 @@ class TwitchBot:
                 except UnicodeDecodeError:
                     None
 
+    # Queues a raw IRC line as if the reader had read it from the socket.
+    # Used to replay captured traffic.
+    def feed(self, line):
+        self.__queue.put(line)
+
     # Formats and prepares an _IRCMessage instance to return.
     # Also updates the userlists if applicable.
-    def incoming(self):
-        text = self.__getText().strip()
- 
-        if text.find("PING") != -1:
-            self.__chat.send(("PONG tmi.twitch.tv\r\n").encode('utf-8'))
-
-        for line in text.split('\n'):
-            tag_included = False
-            
-            if line.startswith('@'):
-                tokens = line.partition(' ')
-                msgtext = tokens[2]
-                tag = tokens[0]
-                tag_included = True
-            else:
-                msgtext = line
- 
-            message = _IRCMessage(msgtext)
-            if message.IRCcmd == '353':
-                self.__setUserList(message)
-            elif message.IRCcmd == 'PART' or message.IRCcmd == 'QUIT':
-                self.__removeUser(message.username)
-            elif message.IRCcmd == 'JOIN':
-                self.__appendUser(message.username)
-            elif message.IRCcmd == 'MODE':
-                self.__updateUser(message.IRCparams)
-
-            if tag_included:
-                message.tag = _IRCTag(tag)
-            else:
-                message.tag = _IRCTag('')
-
-            if message.IRCcmd == 'NOTICE':
-                self.__updateNotice(message.tag.msg_id)
-            elif message.IRCcmd == 'ROOMSTATE':
-                self.__updateRoomstate(message.tag)
-
-            self.__printText(message, text, msgtext)
+    # Blocks until the reader queues a line, or for at most timeout seconds;
+    # on a timeout or once the connection is closed an empty message is
+    # returned.
+    def incoming(self, timeout=None):
+        line = self.__queue.get(timeout)
+        if line is None:
+            line = ''
+
+        tag_included = False
+
+        if line.startswith('@'):
+            tokens = line.partition(' ')
+            msgtext = tokens[2]
+            tag = tokens[0]
+            tag_included = True
+        else:
+            msgtext = line
+
+        message = _IRCMessage(msgtext)
+        if message.IRCcmd == '353':
+            self.__setUserList(message)
+        elif message.IRCcmd == 'PART' or message.IRCcmd == 'QUIT':
+            self.__removeUser(message.username)
+        elif message.IRCcmd == 'JOIN':
+            self.__appendUser(message.username)
+        elif message.IRCcmd == 'MODE':
+            self.__updateUser(message.IRCparams)
+
+        if tag_included:
+            message.tag = _IRCTag(tag)
+        else:
+            message.tag = _IRCTag('')
+        self.__shareNames(message)
+
+        if message.IRCcmd == 'NOTICE':
+            self.__updateNotice(message.tag.notice_id)
+        elif message.IRCcmd == 'ROOMSTATE':
+            self.__updateRoomstate(message.tag)
+
+        self.__printText(message, line, msgtext)
+
+        if message.IRCcmd == 'PRIVMSG':
+            if len(message.IRCparams) > 0:
+                self.__updateMeter(message)
+            if self.__history is not None:
+                self.__history.append(message.username, message.body)
+            if self.__spam is not None and not self.isMod(message.username, message.tag):
+                message.spam = self.__spam.check(message.username, message.body) or ''
+                if message.spam != '':
+                    self.__handleSpam(message)
+            if len(self.__commands) > 0 and message.spam == '':
+                self.__dispatchCommand(message)
 
-        # Only returns the last message for checking
         return message
     
+    # Swaps the message's names for the copies in the user list, so a name
+    # kept by the history, spam detector and meters is stored only once.
+    def __shareNames(self, message):
+        username = self.__usernames.get(message.username)
+        if username is None:
+            return
+        message.username = username
+        if message.tag.login == username:
+            message.tag.login = username
+        if message.tag.display_name == username:
+            message.tag.display_name = username
+
+    def __updateMeter(self, message):
+        channel = message.IRCparams[0]
+        meter = self.__meters.get(channel)
+        if meter is None:
+            meter = _ActivityMeter()
+            self.__meters[channel] = meter
+        meter.update(message.username, message.tag.isCheer)
+
+        if self.__slowopts['rate'] > 0 and channel == self.channel:
+            self.__checkSlow(time.monotonic())
+
     # Bot interaction commands.
     def msg(self, message):
-        self.__chat.send(("PRIVMSG %s :%s\r\n" % (self.channel, message)).encode('utf-8'))
+        self.__send("PRIVMSG %s :%s\r\n" % (self.channel, message))
         if self.__printopts & self.__PRINT_OPT_SELF != 0:
             try:
                 print("SELF: " + message)
@@ -682,7 +1812,10 @@ class TwitchBot:
     def emoteonlyoff(self):
         self.msg(".emoteonlyoff")
     def quitirc(self, message):
-        self.__chat.send(("QUIT :Quit %s\r\n" % message).encode('utf-8'))
+        self.__send("QUIT :Quit %s\r\n" % message)
+        if self.__reader is not None:
+            self.__reader.active = False
+        self.__queue.close()
         socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((self.server, 6667))
         self.__chat.shutdown(socket.SHUT_RDWR)
         self.__chat.close()
@@ -730,14 +1863,19 @@ class TwitchBot:
             if username not in self.modlist:
                 self.modlist.append(username)
 
-        if username not in self.userlist:
+        if username not in self.__usernames:
             self.userlist.append(username)
+            self.__usernames[username] = username
+
+            while len(self.userlist) > self.maxusers:
+                self.__usernames.pop(self.userlist.pop(0), None)
 
     def __removeUser(self, username):
         username = username.strip()
         
-        if username in self.userlist:
+        if username in self.__usernames:
             self.userlist.remove(username)
+            del self.__usernames[username]
         if username in self.modlist:
             self.modlist.remove(username)
 